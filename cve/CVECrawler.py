@@ -1,13 +1,27 @@
-import json
 import logging
 import os
+import signal
+import sqlite3
+import sys
+import tempfile
 import time
-import requests
+import threading
+import ijson
+import orjson
+import httpx
+import zstandard
 import datetime
+import hashlib
+import http.cookiejar
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 
 class CVECrawler:
+    TEXTUAL_CONTENT_TYPES = frozenset({'application/json', 'application/xml', 'application/javascript',
+                                       'application/x-javascript', 'application/x-www-form-urlencoded'})
+
     def __init__(self,
                  storage_path='/usr/src/data',
                  request_timeout=60,
@@ -15,6 +29,10 @@ class CVECrawler:
                  update_interval=7200,  # Suggested by NIST
                  retry_interval=600,
                  retries_for_request=9,
+                 max_concurrent_references=32,
+                 max_concurrent_references_per_host=8,
+                 requests_between_index_checkpoints=10,
+                 max_binary_reference_size=1024 * 1024,
                  mode='info'):
         self.storage_path = storage_path
         self.request_timeout = request_timeout
@@ -22,207 +40,366 @@ class CVECrawler:
         self.update_interval = update_interval
         self.retry_interval = retry_interval
         self.retries_for_request = retries_for_request
+        self.max_concurrent_references = max_concurrent_references
+        self.max_concurrent_references_per_host = max_concurrent_references_per_host
+        self.requests_between_index_checkpoints = requests_between_index_checkpoints
+        self.max_binary_reference_size = max_binary_reference_size
+        self.host_semaphores = {}
+        self.host_semaphores_lock = threading.Lock()
+        self.references_pool = ThreadPoolExecutor(max_workers=max_concurrent_references)
         self.mode = mode
         if self.mode not in ['info', 'changes']:
-            logging.error(f'{self.mode} is not a valid mode')
+            logging.error('%s is not a valid mode', self.mode)
             exit(1)
         if self.mode == 'info':
             self.ENDPOINT_NIST = 'https://services.nvd.nist.gov/rest/json/cves/2.0'
+            self.ITEMS_KEY = 'vulnerabilities'
         if self.mode == 'changes':
             self.ENDPOINT_NIST = 'https://services.nvd.nist.gov/rest/json/cvehistory/2.0'
+            self.ITEMS_KEY = 'cveChanges'
         self.INDEX_FILENAME = '.index.txt'
         self.LAST_UPDATE_FILENAME = '.last_timestamp.txt'
         self.MISSING_INDEXES = 'missing_indexes.txt'
+        self.REFERENCES_CACHE_FILENAME = '.ref_cache.sqlite'
+        self.COMPRESSION_MIGRATION_FILENAME = '.compression_migrated.txt'
+        self.references_cache = None
+        self.references_cache_lock = threading.Lock()
+        self.created_directories = set()
+        self.year_paths = {}
+        self.compressor = zstandard.ZstdCompressor(level=3)
+        self.client = httpx.Client(
+            http2=True,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_concurrent_references,
+                                max_keepalive_connections=max_concurrent_references),
+            headers={'User-Agent': 'cve-crawler'},
+            cookies=http.cookiejar.CookieJar(policy=http.cookiejar.DefaultCookiePolicy(allowed_domains=[])))
         log_format = f'[%(asctime)s] [%(levelname)s] %(message)s'
         logging.basicConfig(level=logging.INFO, format=log_format, datefmt='%Y-%m-%d %H:%M:%S')
+        logging.getLogger('httpx').setLevel(logging.WARNING)
 
     def run(self):
         logging.info('Crawler up')
         os.makedirs(self.storage_path, exist_ok=True)
+        self.load_references_cache()
+        self.load_last_timestamp()
+        if self.mode == 'info':
+            self.compress_uncompressed_data()
         logging.info('Initialisation of the data population')
         self.init_data_population()
         logging.info('Initialisation completed')
 
-        with open(os.path.join(self.storage_path, self.LAST_UPDATE_FILENAME), 'w') as file:
-            file.write(str(datetime.datetime.now().isoformat()))
+        self.save_last_timestamp(str(datetime.datetime.now().isoformat()))
         while True:
-            logging.info(f'Going to sleep for {self.update_interval} seconds due to normal stand-by mode')
+            logging.info('Going to sleep for %d seconds due to normal stand-by mode', self.update_interval)
             time.sleep(self.update_interval)
             logging.info('Crawler woke up from stand-by mode')
-            logging.info(f'Starting the cycle...')
+            logging.info('Starting the cycle...')
             self.maintain_data()
 
     def init_data_population(self):
         try:
             with open(os.path.join(self.storage_path, self.INDEX_FILENAME), 'r') as file:
                 index = int(file.read().strip())
-        except:
+        except (OSError, ValueError):
             index = 0
         if self.mode == 'info':
             entries_for_request = 2000
+            requests_between_checkpoints = self.requests_between_index_checkpoints
         else:
             entries_for_request = 5000
+            requests_between_checkpoints = 1
         actual_retries = 0
-        while True:
-            with open(os.path.join(self.storage_path, self.INDEX_FILENAME), 'w') as file:
-                file.write(str(index))
-            is_exception_or_too_many_request = False
-            query = f'?startIndex={index}'
-            url = self.ENDPOINT_NIST + query
-            logging.info(url)
-            logging.info(f'Request for {entries_for_request} entries from index={index}')
-            try:
-                response = requests.get(url, timeout=self.request_timeout)
-                if response.status_code == 200:
-                    logging.info(f'Data obtained for {entries_for_request} entries from index={index}')
-                    response_json = response.json()
-                    if response_json['startIndex'] >= response_json['totalResults']:
-                        logging.info('Data up to date')
-                        break
-                    self.save_wrapper(response_json)
-                    logging.info(f'Data saved for {entries_for_request} entries from index={index}')
-                    index += entries_for_request
-                    actual_retries = 0
-                else:
-                    logging.error(f'Request failed for index={index}, status code={response.status_code}')
+        requests_since_checkpoint = 0
+        try:
+            while True:
+                is_exception_or_too_many_request = False
+                query = f'?startIndex={index}'
+                url = self.ENDPOINT_NIST + query
+                logging.info('Request for %d entries from index=%d', entries_for_request, index)
+                try:
+                    response = self.request_nvd(url)
+                    next_request_time = time.monotonic() + self.interval_between_requests
+                    if response.status_code == 200:
+                        logging.info('Data obtained for %d entries from index=%d', entries_for_request, index)
+                        if self.save_wrapper(self.stream_items(response)) is None:
+                            logging.info('Data up to date')
+                            break
+                        logging.info('Data saved for %d entries from index=%d', entries_for_request, index)
+                        index += entries_for_request
+                        actual_retries = 0
+                        requests_since_checkpoint += 1
+                        if requests_since_checkpoint == requests_between_checkpoints:
+                            self.atomic_write(self.INDEX_FILENAME, str(index))
+                            requests_since_checkpoint = 0
+                    else:
+                        logging.error('Request failed for index=%d, status code=%d', index, response.status_code)
+                        response.close()
+                        is_exception_or_too_many_request = True
+                        actual_retries += 1
+                except Exception as e:
+                    logging.exception(e)
+                    self.atomic_write(self.INDEX_FILENAME, str(index))
                     is_exception_or_too_many_request = True
                     actual_retries += 1
-            except Exception as e:
-                logging.exception(e)
-                is_exception_or_too_many_request = True
-                actual_retries += 1
-            if actual_retries == self.retries_for_request:
-                logging.error(f'Maximum number of retries reached for index={index}, this request is skipped')
-                with open(os.path.join(self.storage_path, self.MISSING_INDEXES), 'a') as f:
-                    f.write(str(index) + '\n')
-                logging.info(f'Missing index={index} saved into {self.MISSING_INDEXES}')
-                actual_retries = 0
-                index += entries_for_request
-            if is_exception_or_too_many_request:
-                logging.warning(
-                    f'Going to sleep for {self.retry_interval} seconds due to too many requests or an exception')
-                time.sleep(self.retry_interval)
-            else:
-                logging.info(f'Going to sleep for {self.interval_between_requests} seconds before the next request')
-                time.sleep(self.interval_between_requests)
-            logging.info('Crawler woke up')
+                if actual_retries == self.retries_for_request:
+                    logging.error('Maximum number of retries reached for index=%d, this request is skipped', index)
+                    with open(os.path.join(self.storage_path, self.MISSING_INDEXES), 'a') as f:
+                        f.write(str(index) + '\n')
+                    logging.info('Missing index=%d saved into %s', index, self.MISSING_INDEXES)
+                    actual_retries = 0
+                    index += entries_for_request
+                if is_exception_or_too_many_request:
+                    logging.warning('Going to sleep for %d seconds due to too many requests or an exception',
+                                    self.retry_interval)
+                    time.sleep(self.retry_interval)
+                else:
+                    remaining = max(next_request_time - time.monotonic(), 0)
+                    logging.info('Going to sleep for %.1f seconds before the next request', remaining)
+                    time.sleep(remaining)
+                logging.info('Crawler woke up')
+        finally:
+            self.atomic_write(self.INDEX_FILENAME, str(index))
 
-    def save_wrapper(self, response_json):
+    def atomic_write(self, filename, data):
+        path = os.path.join(self.storage_path, filename)
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, data.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(path + '.tmp', path)
+
+    def request_nvd(self, url):
+        request = self.client.build_request('GET', url, timeout=self.request_timeout)
+        return self.client.send(request, stream=True)
+
+    def stream_items(self, response):
+        with tempfile.TemporaryFile() as file:
+            try:
+                for chunk in response.iter_bytes(1 << 20):
+                    file.write(chunk)
+            finally:
+                response.close()
+            file.seek(0)
+            yield from ijson.items(file, f'{self.ITEMS_KEY}.item', use_float=True)
+
+    def load_last_timestamp(self):
+        self.last_timestamp_fd = os.open(os.path.join(self.storage_path, self.LAST_UPDATE_FILENAME),
+                                         os.O_RDWR | os.O_CREAT, 0o644)
+        self.last_timestamp = os.pread(self.last_timestamp_fd, 64, 0).decode().strip()
+
+    def save_last_timestamp(self, timestamp):
+        self.last_timestamp = timestamp
+        os.pwrite(self.last_timestamp_fd, timestamp.encode().ljust(32), 0)
+
+    def save_wrapper(self, items):
+        last_item = None
         if self.mode == 'info':
-            json_list = response_json['vulnerabilities']
-            logging.info('Adding raw references to items')
+            logging.debug('Adding raw references to items')
+            for e in items:
+                self.save_data(self.fetch_and_add_references(e))
+                last_item = e
+            self.save_references_cache()
         else:
-            json_list = response_json['cveChanges']
-        for e in json_list:
-            complete_json = e
-            if self.mode == 'info':
-                complete_json = self.fetch_and_add_references(e)
-            self.save_data(complete_json)
+            changes_by_path = {}
+            for e in items:
+                path = self.get_cve_path_and_filename(e)
+                changes_by_path.setdefault(path, []).append(orjson.dumps(e, option=orjson.OPT_APPEND_NEWLINE))
+                last_item = e
+            for path, lines in changes_by_path.items():
+                self.save_changes(path, lines)
+        return last_item
 
     def fetch_and_add_references(self, json_data):
         references = []
         try:
             for ref in json_data['cve']['references']:
                 references.append(ref['url'])
-            read_references = []
-            ext_ref_id = 0
-            for ref_url in references:
-                try:
-                    response = requests.get(ref_url, timeout=3, stream=True)
-                    if response.status_code == 200:
-                        content_length = response.headers.get('Content-Length')
-                        content_type = response.headers.get('Content-Type', '')
-                        is_textual = any(
-                            kw in content_type for kw in ['text', 'json', 'xml', 'javascript', 'x-www-form-urlencoded'])
-
-                        path = self.get_cve_path_and_filename(json_data)
-                        if is_textual:
-                            if content_length and int(content_length) > 5 * 1024 * 1024:
-                                full_path = path + f'-{ext_ref_id}.txt'
-                                with open(full_path, 'w', encoding=response.encoding or 'utf-8') as f:
-                                    for chunk in response.iter_content(chunk_size=8192, decode_unicode=True):
-                                        f.write(chunk)
-                                read_references.append((ref_url, full_path))
-                                ext_ref_id = ext_ref_id + 1
-                            else:
-                                read_references.append((ref_url, response.text))
-                        else:
-                            full_path = path + f'-{ext_ref_id}'
-                            with open(full_path, 'wb') as f:
-                                for chunk in response.iter_content(chunk_size=8192):
-                                    f.write(chunk)
-                            read_references.append((ref_url, full_path))
-                            ext_ref_id = ext_ref_id + 1
-                    else:
-                        read_references.append((ref_url, response.status_code))
-                except:
-                    read_references.append((ref_url, 'Error with the request'))
+            path = self.get_cve_path_and_filename(json_data)
+            read_references = list(self.references_pool.map(self.fetch_reference, references,
+                                                            [path] * len(references)))
             json_data['cve']['added_references'] = read_references
-        except:
-            pass
+        except (KeyError, TypeError, OSError):
+            logging.debug('Cannot add references to item', exc_info=True)
         return json_data
 
+    def get_host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        with self.host_semaphores_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.Semaphore(self.max_concurrent_references_per_host)
+            return self.host_semaphores[host]
+
+    def fetch_reference(self, ref_url, path):
+        try:
+            full_path = path + '-' + hashlib.sha1(ref_url.encode()).hexdigest()[:16]
+            cached = self.get_cached_reference(full_path)
+            if cached and not os.path.exists(cached['path']):
+                cached = None
+            headers = {}
+            if cached and cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached and cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+            if not cached:
+                skipped_size = self.get_skipped_reference_size(ref_url)
+                if skipped_size is not None:
+                    return ref_url, f'Skipped non-textual content of {skipped_size} bytes'
+            with self.get_host_semaphore(ref_url), \
+                    self.client.stream('GET', ref_url, timeout=3, headers=headers) as response:
+                if response.status_code == 304 and cached:
+                    response.read()
+                    return ref_url, cached['path']
+                if response.status_code == 200:
+                    content_length = response.headers.get('Content-Length')
+                    content_type = response.headers.get('Content-Type', '')
+                    if self.is_textual(content_type):
+                        if not content_length or int(content_length) <= 5 * 1024 * 1024:
+                            response.read()
+                            return ref_url, response.text
+                        saved_path = full_path + '.txt'
+                    else:
+                        saved_path = full_path
+                    with open(saved_path, 'wb', buffering=1 << 20) as f:
+                        for chunk in response.iter_bytes(1 << 20):
+                            f.write(chunk)
+                    self.cache_reference(full_path, response, saved_path)
+                    return ref_url, saved_path
+                response.read()
+                return ref_url, response.status_code
+        except (httpx.HTTPError, OSError, ValueError):
+            logging.debug('Cannot fetch reference %s', ref_url, exc_info=True)
+            return ref_url, 'Error with the request'
+
+    def get_skipped_reference_size(self, ref_url):
+        try:
+            with self.get_host_semaphore(ref_url):
+                head = self.client.head(ref_url, timeout=3)
+        except httpx.HTTPError:
+            logging.debug('HEAD request failed for reference %s', ref_url, exc_info=True)
+            return None
+        content_length = head.headers.get('Content-Length', '')
+        if head.status_code == 200 and not self.is_textual(head.headers.get('Content-Type', '')) \
+                and content_length.isdigit() and int(content_length) > self.max_binary_reference_size:
+            return int(content_length)
+        return None
+
+    def is_textual(self, content_type):
+        media_type = content_type.split(';', 1)[0].strip().lower()
+        return media_type in self.TEXTUAL_CONTENT_TYPES or media_type.startswith('text/') \
+            or media_type.endswith(('+json', '+xml'))
+
+    def get_cached_reference(self, full_path):
+        with self.references_cache_lock:
+            row = self.references_cache.execute(
+                'SELECT etag, last_modified, saved_path FROM references_cache WHERE full_path = ?',
+                (full_path,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'path': row[2]}
+
+    def cache_reference(self, full_path, response, saved_path):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            with self.references_cache_lock:
+                self.references_cache.execute('INSERT OR REPLACE INTO references_cache VALUES (?, ?, ?, ?)',
+                                              (full_path, etag, last_modified, saved_path))
+
+    def load_references_cache(self):
+        self.references_cache = sqlite3.connect(os.path.join(self.storage_path, self.REFERENCES_CACHE_FILENAME),
+                                                check_same_thread=False)
+        self.references_cache.execute('CREATE TABLE IF NOT EXISTS references_cache '
+                                      '(full_path TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, saved_path TEXT)')
+        try:
+            os.remove(os.path.join(self.storage_path, '.ref_cache.json'))
+        except FileNotFoundError:
+            pass
+
+    def save_references_cache(self):
+        with self.references_cache_lock:
+            self.references_cache.commit()
+
     def get_cve_path_and_filename(self, json_data):
         cve = json_data['cve']['id'] if self.mode == 'info' else json_data['change']['cveId']
-        split_cve = cve.split('-')
-        year = split_cve[1]
-        cve_padded = str('{:06d}'.format(int(split_cve[2])))
-        full_path = os.path.join(self.storage_path, year, cve_padded[:2], cve_padded[2:4])
-        os.makedirs(full_path, exist_ok=True)
-        return os.path.join(full_path, f'CVE-{year}-{cve_padded}')
+        _, year, number = cve.split('-')
+        cve_padded = f'{int(number):06d}'
+        year_path = self.year_paths.get(year)
+        if year_path is None:
+            year_path = self.year_paths[year] = os.path.join(self.storage_path, year)
+        full_path = f'{year_path}/{cve_padded[:2]}/{cve_padded[2:4]}'
+        if full_path not in self.created_directories:
+            os.makedirs(full_path, exist_ok=True)
+            self.created_directories.add(full_path)
+        return f'{full_path}/CVE-{year}-{cve_padded}'
+
+    def compress_uncompressed_data(self):
+        if os.path.exists(os.path.join(self.storage_path, self.COMPRESSION_MIGRATION_FILENAME)):
+            return
+        logging.info('Compressing CVE files saved without compression')
+        for root, _, files in os.walk(self.storage_path):
+            for filename in files:
+                if filename.startswith('CVE-') and filename.endswith('.json'):
+                    path = os.path.join(root, filename)
+                    try:
+                        with open(path, 'rb') as file, open(path + '.zst.tmp', 'wb') as compressed_file:
+                            compressed_file.write(self.compressor.compress(file.read()))
+                        os.replace(path + '.zst.tmp', path + '.zst')
+                        os.remove(path)
+                    except OSError:
+                        logging.exception('Cannot compress %s, the file is left uncompressed', path)
+        self.atomic_write(self.COMPRESSION_MIGRATION_FILENAME, str(datetime.datetime.now().isoformat()))
+        logging.info('Compression of CVE files completed')
 
     def save_data(self, json_data):
         try:
             path = self.get_cve_path_and_filename(json_data)
-            if self.mode == 'info':
-                with open(path + '.json', 'w') as file:
-                    file.write(json.dumps(json_data))
-            else:
-                with open(path + '.jsonl', 'a') as file:
-                    file.write(json.dumps(json_data) + '\n')
-        except:
-            raise RuntimeError('Cannot save data')
+            with open(path + '.json.zst.tmp', 'wb') as file:
+                file.write(self.compressor.compress(orjson.dumps(json_data)))
+            os.replace(path + '.json.zst.tmp', path + '.json.zst')
+        except (OSError, TypeError) as e:
+            raise RuntimeError('Cannot save data') from e
+
+    def save_changes(self, path, lines):
+        try:
+            with open(path + '.jsonl', 'ab', buffering=1 << 16) as file:
+                file.writelines(lines)
+        except OSError as e:
+            raise RuntimeError('Cannot save data') from e
 
     def maintain_data(self):
         now = str(datetime.datetime.now().isoformat())
-        try:
-            with open(os.path.join(self.storage_path, self.LAST_UPDATE_FILENAME), 'r') as file:
-                timestamp = file.read().strip()
-        except FileNotFoundError:
+        timestamp = self.last_timestamp
+        if not timestamp:
             logging.info('No last timestamp detected, creating a new one with current time')
-            with open(os.path.join(self.storage_path, self.LAST_UPDATE_FILENAME), 'w') as file:
-                file.write(now)
+            self.save_last_timestamp(now)
             return
-        logging.info(f'Request for update local data from {timestamp}')
+        logging.info('Request for update local data from %s', timestamp)
         if self.mode == 'info':
             query = f'?lastModStartDate={timestamp}&lastModEndDate={now}'
         else:
             query = f'?changeStartDate={timestamp}&changeEndDate={now}'
         url = self.ENDPOINT_NIST + query
         try:
-            response = requests.get(url, timeout=self.request_timeout)
+            response = self.request_nvd(url)
             if response.status_code == 200:
-                response_json = response.json()
-                if self.mode == 'info':
-                    key = 'vulnerabilities'
-                else:
-                    key = 'cveChanges'
-                if response_json[key]:
+                last_item = self.save_wrapper(self.stream_items(response))
+                if last_item is not None:
                     if self.mode == 'info':
-                        last_timestamp = response_json[key][-1]['cve']['lastModified']
+                        last_timestamp = last_item['cve']['lastModified']
                     else:
-                        last_timestamp = response_json[key][-1]['change']['created']
-                    logging.info(f'Data obtained from {timestamp} to {last_timestamp}')
-                    self.save_wrapper(response_json)
-                    logging.info(f'Data saved from {timestamp} to {last_timestamp}')
+                        last_timestamp = last_item['change']['created']
+                    logging.info('Data saved from %s to %s', timestamp, last_timestamp)
                 else:
-                    logging.info(f'Data up to date')
+                    logging.info('Data up to date')
                     last_timestamp = now
-                with open(os.path.join(self.storage_path, self.LAST_UPDATE_FILENAME), 'w') as file:
-                    file.write(last_timestamp)
+                self.save_last_timestamp(last_timestamp)
             else:
-                logging.error(url)
-                logging.error(f'Cannot obtain data from {timestamp}, status code={response.status_code}')
+                logging.error('Cannot obtain data from %s, status code=%d, url=%s',
+                              timestamp, response.status_code, url)
+                response.close()
         except Exception as e:
             logging.exception(e)
 
@@ -232,4 +409,5 @@ if __name__ == '__main__':
     parser.add_argument('--mode', help='What to fetch of the CVEs: info or changes')
 
     args = parser.parse_args()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     CVECrawler(mode=args.mode).run()